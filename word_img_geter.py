@@ -1,6 +1,15 @@
 import os
 import re
+import json
+import base64
+import binascii
+import bisect
+import hashlib
+import time
+import queue
 import shutil
+import traceback
+import multiprocessing
 import urllib.parse
 from datetime import datetime
 import requests
@@ -11,6 +20,16 @@ from io import BytesIO
 from PIL import Image
 from docx.oxml.xmlchemy import OxmlElement
 
+try:
+    import resource  # 仅 Unix 可用
+except ImportError:
+    resource = None
+
+try:
+    import psutil  # 可选，用于监控工作进程内存
+except ImportError:
+    psutil = None
+
 OUTPUT_PY_IMG_DIR = "img/filesimg"
 BASE_URL = "img/filesimg"
 OUTPUT_HEXO_MD_DIR = r"D:\hexo\source\_posts"
@@ -22,6 +41,16 @@ CATEGORIES = ["CSAPP - 深入了解计算机系统"]
 FORMULA_MARKER = "⚡FORMULA⚡"
 FORMULA_END_MARKER = "⚡FORMULA_END⚡"
 
+# 隔离批处理配置
+DOC_TIMEOUT = 600             # 单个文档最长处理时间(秒)
+WORKER_MAX_RSS_MB = 1024      # 工作进程内存(RSS)超过该值时终止该文档(需要 psutil)
+WORKER_MAX_MEMORY_MB = 2048   # 工作进程地址空间硬上限(仅 Unix)，None 表示不限制
+DOCS_PER_WORKER = 10          # 每个工作进程处理的文档数，达到后回收
+MAX_RETRIES = 2               # 外部图片下载遇到临时性错误时的重试次数
+RETRY_BACKOFF = 2             # 重试前等待的秒数，随重试次数递增
+MEMORY_POLL_INTERVAL = 0.5    # 检查工作进程内存的间隔(秒)
+RESULTS_FILE = "batch_results.json"
+
 
 def rewrite_links(content: str, folder_name: str) -> str:
     def rewrite_yuque_links(md_text: str, folder_name: str) -> str:
@@ -35,7 +64,7 @@ def rewrite_links(content: str, folder_name: str) -> str:
         return pattern.sub(repl, md_text)
 
     def rewrite_local_links(md_text: str) -> str:
-        pattern = re.compile(r"\[([^\]]+)\]\((?!https?://)(?!.*?\.(png|jpg|jpeg|gif|bmp))[^)]*\)")
+        pattern = re.compile(r"\[([^\]]+)\]\((?!https?://)(?!data:)(?!.*?\.(png|jpg|jpeg|gif|bmp|webp|svg))[^)]*\)")
 
         def repl(m: re.Match) -> str:
             text = m.group(1)
@@ -92,9 +121,26 @@ def extract_images_from_word(docx_path: str, folder_name: str) -> list:
     return image_info
 
 
+def _is_transient_download_error(e: Exception) -> bool:
+    # 404/403 等 4xx 是失效链接，重试没有意义
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+def _download_to_file(url: str, path: str):
+    response = requests.get(url, stream=True, timeout=10)
+    response.raise_for_status()
+    with open(path, 'wb') as f:
+        for chunk in response.iter_content(8192):
+            f.write(chunk)
+
+
 def download_external_images(content: str, folder_name: str) -> tuple:
     img_pattern = re.compile(r'!\[(.*?)\]\((https?://[^\)]+)\)')
     downloaded_images = []
+    failed_urls = []
     img_counter = 0
 
     local_img_dir = os.path.join(OUTPUT_PY_IMG_DIR, folder_name)
@@ -107,37 +153,171 @@ def download_external_images(content: str, folder_name: str) -> tuple:
         alt_text = match.group(1)
         img_url = match.group(2)
 
-        try:
-            response = requests.get(img_url, stream=True, timeout=10)
-            response.raise_for_status()
+        ext = os.path.splitext(img_url)[1].lower()
+        if not ext or ext not in ['.png', '.jpg', '.jpeg', '.gif']:
+            ext = '.png'
 
-            ext = os.path.splitext(img_url)[1].lower()
-            if not ext or ext not in ['.png', '.jpg', '.jpeg', '.gif']:
-                ext = '.png'
+        image_name = f"{folder_name}_external_{img_counter}{ext}"
+        local_path = os.path.join(local_img_dir, image_name)
 
-            image_name = f"{folder_name}_external_{img_counter}{ext}"
-            img_counter += 1
+        for attempt in range(1, MAX_RETRIES + 2):
+            try:
+                _download_to_file(img_url, local_path)
+                break
+            except Exception as e:
+                transient = _is_transient_download_error(e)
+                if transient and attempt <= MAX_RETRIES:
+                    print(f"  下载图片 {img_url} 失败，第 {attempt} 次重试 ({str(e)})")
+                    time.sleep(RETRY_BACKOFF * attempt)
+                    continue
+
+                print(f"  警告: 无法下载图片 {img_url} ({str(e)})")
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+                if isinstance(e, requests.RequestException):
+                    failed_urls.append(img_url)
+                return match.group(0)
 
-            local_path = os.path.join(local_img_dir, image_name)
-            with open(local_path, 'wb') as f:
-                for chunk in response.iter_content(8192):
-                    f.write(chunk)
+        img_counter += 1
+        hexo_path = os.path.join(hexo_img_dir, image_name)
+        shutil.copy(local_path, hexo_path)
+
+        downloaded_images.append((image_name, False))
+
+        img_url = f"{BASE_URL}/{folder_name}/{image_name}"
+        encoded_url = img_url.replace(' ', '%20')
+        return f"![{alt_text}]({encoded_url})"
 
+    processed_content = img_pattern.sub(replace_external_image, content)
+    return processed_content, downloaded_images, failed_urls
+
+
+DATA_URI_EXTENSIONS = {
+    'png': '.png',
+    'jpeg': '.jpg',
+    'jpg': '.jpg',
+    'gif': '.gif',
+    'bmp': '.bmp',
+    'webp': '.webp',
+    'svg+xml': '.svg',
+}
+BASE64_CHUNK_SIZE = 64 * 1024  # 必须是 4 的倍数
+# 围栏代码块或行内代码，其中的 data URI 按原样保留
+CODE_PATTERN = re.compile(r'(?ms:^[ \t]*(`{3,}|~{3,}).*?^[ \t]*\1)|(`+)[^`\n].*?(?<!`)\2(?!`)')
+
+
+def _find_code_ranges(content: str) -> tuple:
+    starts, ends = [], []
+    for m in CODE_PATTERN.finditer(content):
+        starts.append(m.start())
+        ends.append(m.end())
+    return starts, ends
+
+
+def _in_code(code_ranges: tuple, pos: int) -> bool:
+    starts, ends = code_ranges
+    i = bisect.bisect_right(starts, pos) - 1
+    return i >= 0 and pos < ends[i]
+
+
+def _decode_base64_to_file(text: str, start: int, end: int, f) -> str:
+    # 按块解码 text[start:end]，避免一次性复制整个 base64 字符串
+    digest = hashlib.sha1()
+    remainder = ""
+    for pos in range(start, end, BASE64_CHUNK_SIZE):
+        chunk = remainder + re.sub(r'\s+', '', text[pos:min(pos + BASE64_CHUNK_SIZE, end)])
+        usable = len(chunk) - len(chunk) % 4
+        remainder = chunk[usable:]
+        data = base64.b64decode(chunk[:usable], validate=True)
+        digest.update(data)
+        f.write(data)
+    if remainder:
+        raise binascii.Error("base64 数据长度不正确")
+    return digest.hexdigest()
+
+
+def extract_embedded_images(content: str, folder_name: str) -> tuple:
+    # 允许 base64 之前带 ;charset=utf-8 之类的参数
+    mime = r'data:image/([\w.+-]+)(?:;[\w.+-]+=[^;,\s)"\']*)*;base64,'
+    payload = r'\s*([A-Za-z0-9+/][A-Za-z0-9+/=\s]*)'
+    img_pattern = re.compile(r'!\[(.*?)\]\(' + mime + payload + r'(\s+"[^"]*")?\)')
+    html_pattern = re.compile(r'(<img\b[^>]*?\bsrc\s*=\s*)(["\'])' + mime + payload + r'\2')
+    embedded_images = []
+    saved_by_digest = {}
+    img_counter = 0
+    html_count = 0
+
+    local_img_dir = os.path.join(OUTPUT_PY_IMG_DIR, folder_name)
+    os.makedirs(local_img_dir, exist_ok=True)
+    hexo_img_dir = os.path.join(OUTPUT_HEXO_IMG_DIR, folder_name)
+    os.makedirs(hexo_img_dir, exist_ok=True)
+
+    def save_embedded_image(match, mime_group: int, payload_group: int):
+        nonlocal img_counter
+        mime = match.group(mime_group).lower()
+        ext = DATA_URI_EXTENSIONS.get(mime)
+        if ext is None:
+            print(f"  警告: 不支持的内嵌图片类型 image/{mime}，保留原内容")
+            return None
+
+        image_name = f"{folder_name}_embedded_{img_counter}{ext}"
+        local_path = os.path.join(local_img_dir, image_name)
+        try:
+            with open(local_path, 'wb') as f:
+                digest = _decode_base64_to_file(
+                    match.string, match.start(payload_group), match.end(payload_group), f)
+                if f.tell() == 0:
+                    raise ValueError("内嵌图片为空")
+        except (binascii.Error, ValueError) as e:
+            os.remove(local_path)
+            print(f"  警告: 无法解码内嵌图片 ({str(e)})")
+            return None
+
+        # 相同内容的图片只保留一份
+        if digest in saved_by_digest:
+            os.remove(local_path)
+            image_name = saved_by_digest[digest]
+        else:
+            img_counter += 1
+            saved_by_digest[digest] = image_name
             hexo_path = os.path.join(hexo_img_dir, image_name)
             shutil.copy(local_path, hexo_path)
 
-            downloaded_images.append((image_name, False))
+        img_url = f"{BASE_URL}/{folder_name}/{image_name}"
+        return image_name, img_url.replace(' ', '%20')
 
-            img_url = f"{BASE_URL}/{folder_name}/{image_name}"
-            encoded_url = img_url.replace(' ', '%20')
-            return f"![{alt_text}]({encoded_url})"
+    def replace_embedded_image(match):
+        if _in_code(code_ranges, match.start()):
+            return match.group(0)
+        saved = save_embedded_image(match, 2, 3)
+        if saved is None:
+            return match.group(0)
 
-        except Exception as e:
-            print(f"  警告: 无法下载图片 {img_url} ({str(e)})")
+        image_name, encoded_url = saved
+        embedded_images.append((image_name, False))
+        title = match.group(4) or ""
+        return f"![{match.group(1)}]({encoded_url}{title})"
+
+    def replace_html_image(match):
+        nonlocal html_count
+        if _in_code(code_ranges, match.start()):
+            return match.group(0)
+        saved = save_embedded_image(match, 3, 4)
+        if saved is None:
             return match.group(0)
 
-    processed_content = img_pattern.sub(replace_external_image, content)
-    return processed_content, downloaded_images
+        html_count += 1
+        quote = match.group(2)
+        return f"{match.group(1)}{quote}{saved[1]}{quote}"
+
+    code_ranges = _find_code_ranges(content)
+    processed_content = img_pattern.sub(replace_embedded_image, content)
+    # 第一轮替换改变了位置，需要重新查找代码范围
+    code_ranges = _find_code_ranges(processed_content)
+    processed_content = html_pattern.sub(replace_html_image, processed_content)
+    if html_count:
+        print(f"  提取了 {html_count} 张 HTML <img> 内嵌图片")
+    return processed_content, embedded_images
 
 
 def mark_formulas(content: str) -> str:
@@ -167,6 +347,14 @@ def replace_formula_markers(content: str) -> str:
     return content.replace(FORMULA_END_MARKER, "")
 
 
+def _write_text_atomic(path: str, text: str):
+    # 先写临时文件再替换，工作进程在写入过程中被终止也不会留下截断的文件
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
 def process_markdown_file(md_path: str, folder_name: str, image_info: list):
     print(f"  开始处理Markdown文件: {md_path}")
 
@@ -181,6 +369,11 @@ def process_markdown_file(md_path: str, folder_name: str, image_info: list):
         content = content.replace(match.group(0), '', 1)
         print(f"  已移除现有的Front-Matter")
 
+    # 提取内嵌的 base64 图片，先于其他步骤执行以缩小后续处理的文本
+    print("  开始提取内嵌图片")
+    content, embedded_images = extract_embedded_images(content, folder_name)
+    print(f"  完成提取内嵌图片，共 {len(embedded_images)} 处，长度缩减为: {len(content)} 字符")
+
     # 标记公式
     print("  开始标记公式")
     content = mark_formulas(content)
@@ -188,10 +381,10 @@ def process_markdown_file(md_path: str, folder_name: str, image_info: list):
 
     # 下载并替换外部图片
     print("  开始下载并替换外部图片")
-    content, external_images = download_external_images(content, folder_name)
-    print(f"  完成下载并替换外部图片，共下载 {len(external_images)} 张外部图片")
+    content, external_images, failed_urls = download_external_images(content, folder_name)
+    print(f"  完成下载并替换外部图片，共下载 {len(external_images)} 张外部图片，失败 {len(failed_urls)} 张")
 
-    # 合并图片信息
+    # 合并图片信息(内嵌图片已就地替换，不参与按顺序替换)
     all_images = image_info + external_images
     formula_images = [img for img, is_formula in all_images if is_formula]
     non_formula_images = [img for img, is_formula in all_images if not is_formula]
@@ -217,6 +410,8 @@ def process_markdown_file(md_path: str, folder_name: str, image_info: list):
     img_pattern = re.compile(r'!\[(.*?)\]\(([^)]+)\)')
     img_count = 0
     skipped_formulas = 0
+    embedded_url_prefix = f"{BASE_URL}/{folder_name}/{folder_name}_embedded_".replace(' ', '%20')
+    code_ranges = _find_code_ranges(content)
 
     def replace_image(match):
         nonlocal img_count, skipped_formulas
@@ -228,6 +423,11 @@ def process_markdown_file(md_path: str, folder_name: str, image_info: list):
                 skipped_formulas += 1
                 return match.group(0)
 
+        # 代码中的图片语法、已就地替换的内嵌图片以及未能提取的 data URI 保持不变
+        img_src = match.group(2)
+        if _in_code(code_ranges, match_start) or img_src.startswith((embedded_url_prefix, 'data:')):
+            return match.group(0)
+
         # 替换普通图片
         if img_count < len(non_formula_images):
             alt_text = match.group(1)
@@ -235,7 +435,7 @@ def process_markdown_file(md_path: str, folder_name: str, image_info: list):
             img_count += 1
             img_url = f"{BASE_URL}/{folder_name}/{img_name}"
             encoded_url = img_url.replace(' ', '%20')  # 替换空格
-            return f"%7Bencoded_url%7D"
+            return f"![{alt_text}]({encoded_url})"
 
         return match.group(0)
 
@@ -243,6 +443,12 @@ def process_markdown_file(md_path: str, folder_name: str, image_info: list):
     content = img_pattern.sub(replace_image, content)
     print(f"  完成替换内嵌图片链接: 处理了 {img_count} 张图片, 跳过了 {skipped_formulas} 个公式位置")
 
+    # 确认内嵌图片链接没有被后续步骤改写
+    for img_name, _ in embedded_images:
+        img_url = f"{BASE_URL}/{folder_name}/{img_name}".replace(' ', '%20')
+        if img_url not in content:
+            print(f"  警告: 内嵌图片 {img_name} 的链接在处理后丢失")
+
     # 重写链接
     print("  开始重写链接")
     content = rewrite_links(content, folder_name)
@@ -271,24 +477,20 @@ def process_markdown_file(md_path: str, folder_name: str, image_info: list):
     final_content = fm + content
 
     # 保存到原始位置
-    with open(md_path, 'w', encoding='utf-8') as f:
-        f.write(final_content)
+    _write_text_atomic(md_path, final_content)
     print(f"  已保存到原始位置: {md_path}")
 
     # 保存到Hexo目录
     hexo_md_path = os.path.join(OUTPUT_HEXO_MD_DIR, os.path.basename(md_path))
     os.makedirs(os.path.dirname(hexo_md_path), exist_ok=True)
-    with open(hexo_md_path, 'w', encoding='utf-8') as f:
-        f.write(final_content)
+    _write_text_atomic(hexo_md_path, final_content)
     print(f"  已保存到Hexo目录: {hexo_md_path}")
 
-    return img_count, len(external_images), skipped_formulas
-
+    return img_count, len(external_images), skipped_formulas, len(failed_urls)
 
-def batch_process():
-    cwd = os.getcwd()
-    processed_count = 0
 
+def find_documents(cwd: str) -> list:
+    documents = []
     for file_name in os.listdir(cwd):
         if not file_name.lower().endswith('.docx'):
             continue
@@ -301,31 +503,167 @@ def batch_process():
             print(f"跳过 {file_name}，未找到对应的Markdown文件")
             continue
 
+        documents.append((file_name, base_name, md_path))
+    return documents
+
+
+def process_document(file_name: str, base_name: str, md_path: str) -> tuple:
+    print(f"处理: {base_name}")
+    # 提取图片
+    image_info = extract_images_from_word(file_name, base_name)
+    print(f"  找到图片: {len(image_info)}")
+
+    # 处理Markdown文件
+    img_count, external_count, skipped_formulas, failed_downloads = process_markdown_file(
+        md_path, base_name, image_info)
+
+    print(
+        f"  成功处理: 替换了 {img_count} 张图片, 下载了 {external_count} 张外部图片, "
+        f"跳过了 {skipped_formulas} 个公式位置, {failed_downloads} 张外部图片下载失败"
+    )
+    return img_count, external_count, skipped_formulas, failed_downloads
+
+
+def _worker_loop(task_queue, result_queue, max_docs: int, max_memory_mb):
+    # 限制地址空间，超限时在工作进程内抛出 MemoryError 而不是拖垮整台机器
+    if resource is not None and max_memory_mb:
+        limit = int(max_memory_mb * 1024 * 1024)
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ValueError, OSError) as e:
+            print(f"  警告: 无法设置内存上限 ({str(e)})")
+
+    for done in range(1, max_docs + 1):
+        task = task_queue.get()
+        if task is None:
+            break
+
+        file_name, base_name, md_path = task
+        result = {"status": "ok", "error": None, "recycle": done == max_docs}
         try:
-            print(f"处理: {base_name}")
-            # 提取图片
-            image_info = extract_images_from_word(file_name, base_name)
-            print(f"  找到图片: {len(image_info)}")
-
-            # 处理Markdown文件
-            img_count, external_count, skipped_formulas = process_markdown_file(
-                md_path, base_name, image_info)
-
-            print(
-                f"  成功处理: 替换了 {img_count} 张图片, 下载了 {external_count} 张外部图片, "
-                f"跳过了 {skipped_formulas} 个公式位置"
-            )
-            processed_count += 1
+            img_count, external_count, skipped_formulas, failed_downloads = process_document(
+                file_name, base_name, md_path)
+            result.update(images=img_count, external_images=external_count,
+                          skipped_formulas=skipped_formulas, failed_downloads=failed_downloads)
+        except MemoryError:
+            result.update(status="memory", error="超出内存上限", recycle=True)
         except Exception as e:
-            import traceback
-            print(f"  处理 {base_name} 时出错: {str(e)}")
             traceback.print_exc()
+            result.update(status="error", error=f"{type(e).__name__}: {str(e)}")
+
+        result_queue.put(result)
+        if result["recycle"]:
+            return
 
-    print(f"\n处理完成! 共处理 {processed_count} 个文档")
+
+def _write_results(results: list, results_path: str):
+    _write_text_atomic(results_path, json.dumps(results, ensure_ascii=False, indent=2))
+
+
+def batch_process(results_path: str = RESULTS_FILE):
+    """在独立的工作进程中逐个处理文档。
+
+    单个文档超时、超出内存或使工作进程崩溃时只记录该文档失败，批处理继续；
+    工作进程每处理 DOCS_PER_WORKER 个文档后回收，内存(RSS)超过 WORKER_MAX_RSS_MB
+    时立即终止(需要 psutil)。结果写入 results_path (JSON)。
+    """
+    cwd = os.getcwd()
+    results = []
+    worker = task_queue = result_queue = worker_proc = None
+
+    if psutil is None and WORKER_MAX_RSS_MB:
+        print("警告: 未安装 psutil，WORKER_MAX_RSS_MB 不会生效")
+
+    def start_worker():
+        nonlocal worker, task_queue, result_queue, worker_proc
+        task_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        worker = multiprocessing.Process(
+            target=_worker_loop,
+            args=(task_queue, result_queue, DOCS_PER_WORKER, WORKER_MAX_MEMORY_MB),
+            daemon=True)
+        worker.start()
+        worker_proc = psutil.Process(worker.pid) if psutil is not None else None
+
+    def stop_worker(kill: bool):
+        nonlocal worker, worker_proc
+        if kill:
+            worker.terminate()
+        worker.join(5)
+        if worker.is_alive():
+            worker.kill()
+            worker.join()
+        worker = worker_proc = None
+
+    def worker_rss_mb():
+        if worker_proc is None:
+            return None
+        try:
+            return worker_proc.memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            return None
+
+    def wait_result(deadline: float):
+        # 轮询结果，同时检测工作进程内存以及是否意外退出(如被系统 OOM 终止)
+        peak_rss = 0.0
+        while True:
+            rss = worker_rss_mb()
+            if rss is not None:
+                peak_rss = max(peak_rss, rss)
+                if WORKER_MAX_RSS_MB and rss > WORKER_MAX_RSS_MB:
+                    result = {"status": "memory", "error": f"内存占用 {rss:.0f} MB 超过 {WORKER_MAX_RSS_MB} MB",
+                              "recycle": True, "kill": True}
+                    break
+            try:
+                result = result_queue.get(timeout=MEMORY_POLL_INTERVAL)
+                break
+            except queue.Empty:
+                pass
+            if not worker.is_alive():
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    result = {"status": "crashed", "error": f"工作进程异常退出 (exitcode={worker.exitcode})",
+                              "recycle": True}
+                break
+            if time.monotonic() > deadline:
+                result = {"status": "timeout", "error": f"超过 {DOC_TIMEOUT} 秒未完成",
+                          "recycle": True, "kill": True}
+                break
+        result["peak_rss_mb"] = round(peak_rss, 1) if worker_proc is not None else None
+        return result
+
+    try:
+        for file_name, base_name, md_path in find_documents(cwd):
+            started = time.monotonic()
+            if worker is None:
+                start_worker()
+            task_queue.put((file_name, base_name, md_path))
+            result = wait_result(time.monotonic() + DOC_TIMEOUT)
+
+            if result.pop("recycle"):
+                stop_worker(kill=result.pop("kill", False))
+
+            if result["status"] != "ok":
+                print(f"  处理 {base_name} 失败 ({result['status']}): {result['error']}")
+
+            record = {"document": file_name, "elapsed": round(time.monotonic() - started, 2)}
+            record.update(result)
+            results.append(record)
+            # 每个文档完成后立即落盘，批处理中途被终止也能保留已有结果
+            _write_results(results, results_path)
+    finally:
+        if worker is not None:
+            task_queue.put(None)
+            stop_worker(kill=False)
+
+    succeeded = sum(1 for r in results if r["status"] == "ok")
+    print(f"\n处理完成! 成功 {succeeded} 个, 失败 {len(results) - succeeded} 个, 结果已写入 {results_path}")
+    return results
 
 
 if __name__ == '__main__':
     os.makedirs(OUTPUT_PY_IMG_DIR, exist_ok=True)
     os.makedirs(OUTPUT_HEXO_IMG_DIR, exist_ok=True)
     os.makedirs(OUTPUT_HEXO_MD_DIR, exist_ok=True)
-    batch_process()
\ No newline at end of file
+    batch_process()